@@ -0,0 +1,33 @@
+import argparse
+
+import torch
+
+from tps import Handler
+
+from hparams import create_hparams
+from utils.data_utils import TextMelLoader
+
+
+def precompute_mels(hparams, device):
+    assert isinstance(hparams.text_handler_cfg, str)
+    text_handler = Handler.from_config(hparams.text_handler_cfg)
+    text_handler.out_max_length = None
+
+    for filelist_path in (hparams.training_files, hparams.validation_files):
+        print("Precomputing mel-spectrograms for {}".format(filelist_path))
+        dataset = TextMelLoader(text_handler, filelist_path, hparams)
+        dataset.precompute_mels(hparams.mels_path, device)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--hparams_path", type=str, default="./data/hparams.yaml",
+                        required=False, help="hparams path")
+    parser.add_argument("--device", type=str, default="cuda:0" if torch.cuda.is_available() else "cpu",
+                        required=False, help="device to compute mel-spectrograms on")
+    args = parser.parse_args()
+
+    hparams = create_hparams(args.hparams_path)
+    assert hparams.mels_path, "mels_path must be set to store the mel-spectrograms"
+
+    precompute_mels(hparams, torch.device(args.device))
@@ -34,6 +34,7 @@ import re
 import time
 import math
 import argparse
+import inspect
 from shutil import copyfile
 from itertools import chain
 
@@ -48,7 +49,7 @@ from torch.utils.data import DataLoader
 from tps import Handler
 
 from model import load_model
-from utils.data_utils import TextMelLoader, TextMelCollate, CustomSampler
+from utils.data_utils import TextMelLoader, TextMelCollate, CustomSampler, BatchMelExtractor, worker_init_fn
 from utils.distributed import apply_gradient_allreduce
 from modules.optimizers import build_optimizer, build_scheduler, SchedulerTypes
 from modules.loss_function import OverallLoss
@@ -96,16 +97,28 @@ def prepare_dataloaders(hparams, distributed_run=False):
 
     trainset = TextMelLoader(text_handler, hparams.training_files, hparams)
     valset = TextMelLoader(text_handler, hparams.validation_files, hparams)
-    collate_fn = TextMelCollate(hparams.n_frames_per_step)
+    pin_memory = hparams.pin_memory and torch.cuda.is_available()
+    # CustomSampler orders each batch by text length
+    collate_fn = TextMelCollate(hparams.n_frames_per_step, hparams.hop_length, pin_memory,
+                                presorted=not distributed_run)
 
     if distributed_run:
         train_sampler = DistributedSampler(trainset)
     else:
         train_sampler = CustomSampler(trainset, hparams.batch_size, hparams.shuffle, hparams.optimize, hparams.len_diff)
 
-    train_loader = DataLoader(trainset, num_workers=1, sampler=train_sampler,
-                              batch_size=hparams.batch_size, pin_memory=False,
-                              drop_last=False, collate_fn=collate_fn)
+    workers_options = {}
+    if hparams.num_workers > 0:
+        # persistent_workers and prefetch_factor are only accepted by DataLoader since torch 1.7
+        dataloader_params = inspect.signature(DataLoader.__init__).parameters
+        workers_options = {key: value for key, value in (("persistent_workers", hparams.persistent_workers),
+                                                         ("prefetch_factor", hparams.prefetch_factor))
+                           if key in dataloader_params}
+
+    train_loader = DataLoader(trainset, num_workers=hparams.num_workers, sampler=train_sampler,
+                              batch_size=hparams.batch_size, pin_memory=pin_memory,
+                              drop_last=False, collate_fn=collate_fn, worker_init_fn=worker_init_fn,
+                              **workers_options)
     return train_loader, valset, collate_fn
 
 
@@ -182,7 +195,8 @@ def save_checkpoint(model, optimizer, lr_scheduler, criterion, iteration, hparam
     torch.save(train_dict, filepath)
 
 
-def validate(model, criterion, valset, iteration, batch_size, collate_fn, logger, distributed_run, rank, n_gpus):
+def validate(model, criterion, valset, iteration, batch_size, collate_fn, logger, distributed_run, rank, n_gpus,
+             mel_extractor=None):
     """Handles all the validation scoring and printing"""
     shuffle = not distributed_run
 
@@ -193,9 +207,11 @@ def validate(model, criterion, valset, iteration, batch_size, collate_fn, logger
         val_sampler = DistributedSampler(valset) if distributed_run else None
         val_loader = DataLoader(valset, sampler=val_sampler, num_workers=1,
                                 shuffle=shuffle, batch_size=batch_size,
-                                pin_memory=False, collate_fn=collate_fn)
+                                pin_memory=False, collate_fn=collate_fn, worker_init_fn=worker_init_fn)
 
         for i, batch in enumerate(val_loader):
+            if mel_extractor is not None:
+                batch = mel_extractor(batch)
             inputs, alignments, inputs_ctc = model.parse_batch(batch)
 
             outputs, decoder_outputs = model(inputs)
@@ -252,6 +268,7 @@ def train(hparams, distributed_run=False, rank=0, n_gpus=None):
     logger = prepare_directories_and_logger(hparams.output_dir, hparams.log_dir, rank)
     copyfile(hparams.path, os.path.join(hparams.output_dir, 'hparams.yaml'))
     train_loader, valset, collate_fn = prepare_dataloaders(hparams, distributed_run)
+    mel_extractor = BatchMelExtractor(hparams) if valset.batch_mel_extraction else None
 
     # Load checkpoint if one exists
     iteration = 0
@@ -277,6 +294,8 @@ def train(hparams, distributed_run=False, rank=0, n_gpus=None):
             start = time.perf_counter()
 
             model.zero_grad()
+            if mel_extractor is not None:
+                batch = mel_extractor(batch)
             inputs, alignments, inputs_ctc = model.parse_batch(batch)
 
             outputs, decoder_outputs = model(inputs)
@@ -323,7 +342,7 @@ def train(hparams, distributed_run=False, rank=0, n_gpus=None):
 
             if not is_overflow and (iteration % hparams.iters_per_checkpoint == 0):
                 val_loss = validate(model, criterion, valset, iteration, hparams.batch_size, collate_fn, logger,
-                                    distributed_run, rank, n_gpus)
+                                    distributed_run, rank, n_gpus, mel_extractor)
                 if rank == 0:
                     checkpoint = os.path.join(
                         hparams.output_dir, "checkpoint_{}".format(iteration))
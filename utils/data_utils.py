@@ -30,18 +30,20 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 import os
-from itertools import chain
+import warnings
 
 import numpy as np
 import librosa
+import soundfile as sf
 import torch
 import torch.utils.data
-from scipy.io.wavfile import read
+from torch.nn.utils.rnn import pad_sequence
+from threadpoolctl import threadpool_limits
 
 from tps import prob2bool, symbols, cleaners
 
 from modules import layers
-from utils.utils import load_filepaths_and_text, Inputs, InputsCTC
+from utils.utils import load_filepaths_and_text, to_gpu, Inputs, InputsCTC
 from modules.loss_function import AttentionTypes
 
 
@@ -61,6 +63,60 @@ def get_ctc_symbols_length(charset):
     return len(get_ctc_symbols(charset))
 
 
+def build_stft(hparams):
+    return layers.TacotronSTFT(
+        hparams.filter_length, hparams.hop_length, hparams.win_length,
+        hparams.n_mel_channels, hparams.sampling_rate, hparams.mel_fmin,
+        hparams.mel_fmax)
+
+
+def get_mel_length(num_samples, hop_length):
+    """Number of frames TacotronSTFT produces for the audio of num_samples length"""
+    return num_samples // hop_length + 1
+
+
+def worker_init_fn(worker_id):
+    """
+    Limits BLAS/OpenMP pools (used by numpy and librosa) of DataLoader workers to a single thread:
+    otherwise every worker tries to occupy all the cores and num_workers times oversubscribes them.
+    torch itself is already limited to one thread in the workers by DataLoader
+    """
+    threadpool_limits(1)
+
+
+def fill_padded(padded, items):
+    """Copies 2d arrays into the top left corners of the padded batch array and zeroes the rest of it"""
+    for i, item in enumerate(items):
+        height, width = item.shape
+
+        padded[i, :height, :width] = item
+        padded[i, :height, width:] = 0
+        padded[i, height:, :] = 0
+
+
+class PackedStrings:
+    """
+    Read-only list of strings kept in two numpy arrays: utf-8 bytes and offsets.
+    Unlike a list of str objects, it isn't copied page by page into forked DataLoader workers
+    when refcounts of its elements are touched.
+    """
+    def __init__(self, strings):
+        encoded = [string.encode("utf-8") for string in strings]
+
+        self._offsets = np.cumsum([0] + [len(elem) for elem in encoded], dtype=np.int64)
+        self._buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+
+    def __getitem__(self, index):
+        # normalizes negative indices and raises IndexError out of range, as list does
+        index = range(len(self))[index]
+        return self._buffer[self._offsets[index]:self._offsets[index + 1]].tobytes().decode("utf-8")
+
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
 class TextMelLoader(torch.utils.data.Dataset):
     """
         1) loads audio,text pairs
@@ -70,8 +126,12 @@ class TextMelLoader(torch.utils.data.Dataset):
     def __init__(self, text_handler, filelist_path, hparams):
         self.text_handler = text_handler
 
-        self.data = load_filepaths_and_text(filelist_path)
+        data = load_filepaths_and_text(filelist_path)
+        self.audio_names = PackedStrings(elem[0] for elem in data)
+        self.texts = PackedStrings(elem[1] for elem in data)
+        self.text_lengths = np.array([len(elem[1]) for elem in data], dtype=np.int32)
         self.audio_path = hparams.audios_path
+        self.mels_path = hparams.mels_path or hparams.audios_path
         self.alignment_path = hparams.alignments_path
 
         self.add_silence = hparams.add_silence
@@ -80,38 +140,54 @@ class TextMelLoader(torch.utils.data.Dataset):
         self.trim_silence = hparams.trim_silence
         self.trim_top_db = hparams.trim_top_db
 
-        self.max_wav_value = hparams.max_wav_value
         self.sampling_rate = hparams.sampling_rate
         self.load_mel_from_disk = hparams.load_mel_from_disk
+        self.batch_mel_extraction = hparams.batch_mel_extraction and not self.load_mel_from_disk
+        self.warn_on_mel_dtype = True
+
+        self.mel_codec = None
+        if hparams.compress_mels:
+            from numcodecs import Zstd
+            self.mel_codec = Zstd(level=3)
 
-        self.stft = layers.TacotronSTFT(
-            hparams.filter_length, hparams.hop_length, hparams.win_length,
-            hparams.n_mel_channels, hparams.sampling_rate, hparams.mel_fmin,
-            hparams.mel_fmax)
+        self.stft = build_stft(hparams)
 
         self.word_level_prob = hparams.word_level_prob
         self.mask_stress = hparams.mask_stress
         self.mask_phonemes = hparams.mask_phonemes
 
+        # with word level probabilities masking is random for every call, so sequences can't be reused
+        self._sequences_cache = {} if not self.word_level_prob else None
+
         self.get_alignments = hparams.guided_attention_type == AttentionTypes.prealigned
         if self.get_alignments:
             assert not self.word_level_prob and not self.add_silence
 
         self.use_mmi = hparams.use_mmi
         self.ctc_symbol_to_id = None
+        self._ctc_lut = None
         if hparams.use_mmi:
             self.ctc_symbol_to_id = {s: i for i, s in enumerate(get_ctc_symbols(hparams.charset))}
 
+            # text handler id -> ctc id, -1 for the symbols which are absent in the ctc set
+            id_to_symbol = self.text_handler.id_to_symbol
+            self._ctc_lut = torch.tensor([self.ctc_symbol_to_id.get(id_to_symbol[i], -1)
+                                          for i in range(len(id_to_symbol))], dtype=torch.int32)
+
 
     def __getitem__(self, index):
         if isinstance(index, slice):
-            return (self.get_data(data) for data in self.data[index])
+            return (self.get_data(self.get_sample(i)) for i in range(len(self))[index])
         else:
-            return self.get_data(self.data[index])
+            return self.get_data(self.get_sample(index))
 
 
     def __len__(self):
-        return len(self.data)
+        return len(self.audio_names)
+
+
+    def get_sample(self, index):
+        return self.audio_names[index], self.texts[index]
 
 
     def _prob2bool(self, prob):
@@ -124,62 +200,78 @@ class TextMelLoader(torch.utils.data.Dataset):
 
         audio_name, text = sample
 
-        sequence = self.get_text(text, mask_stress, mask_phonemes)
-        mel = self.get_mel(audio_name)
+        sequence = torch.from_numpy(self.get_text(text, mask_stress, mask_phonemes))
+
+        if self.batch_mel_extraction:
+            # mel-spectrograms are computed later for the whole batch by BatchMelExtractor
+            audio = self.get_audio(audio_name, self.trim_silence, self.add_silence)
+            target = torch.squeeze(audio, 0)
+            target_len = get_mel_length(target.size(0), self.hop_length)
+        else:
+            target = self.get_mel(audio_name)
+            target_len = target.size(1)
 
         alignment = None
         if self.get_alignments:
-            target_shape = (mel.size(1), sequence.size(0))
+            target_shape = (target_len, len(sequence))
             alignment = self.get_alignment(audio_name, mask_stress, mask_phonemes, target_shape)
 
         ctc_sequence = None
         if self.use_mmi:
-            ctc_sequence = self.get_ctc_text(sequence.data.cpu().numpy())
+            ctc_sequence = self.get_ctc_text(sequence)
 
-        return sequence, mel, alignment, ctc_sequence
+        return sequence, target, alignment, ctc_sequence
 
 
     def get_text(self, text, mask_stress, mask_phonemes):
+        cache_key = (text, mask_stress, mask_phonemes)
+        if self._sequences_cache is not None and cache_key in self._sequences_cache:
+            return self._sequences_cache[cache_key]
+
         preprocessed_text = self.text_handler(
             text, cleaners.light_punctuation_cleaners, None, False,
             mask_stress=mask_stress, mask_phonemes=mask_phonemes
         )
         preprocessed_text = self.text_handler.check_eos(" ".join(preprocessed_text))
         text_vector = self.text_handler.text2vec(preprocessed_text)
+        text_vector = np.asarray(text_vector, dtype=np.int32)
+
+        if self._sequences_cache is not None:
+            self._sequences_cache[cache_key] = text_vector
 
-        text_tensor = torch.IntTensor(text_vector)
-        return text_tensor
+        return text_vector
 
 
     def get_audio(self, filename, trim_silence=False, add_silence=False):
         filepath = os.path.join(self.audio_path, filename)
 
-        sample_rate, audio = read(filepath)
-        audio = np.float32(audio / self.max_wav_value) # faster than loading using librosa
+        # soundfile scales integer PCM to [-1, 1] itself, so no extra pass over the audio is needed
+        audio, sample_rate = sf.read(filepath, dtype="float32", always_2d=False)
 
         if sample_rate != self.sampling_rate:
             raise ValueError("{} SR doesn't match target {} SR".format(sample_rate, self.sampling_rate))
 
-        audio_ = audio.copy()
-
         if trim_silence:
             idxs = librosa.effects.split(
-                audio_,
+                audio,
                 top_db=self.trim_top_db,
                 frame_length=self.ft_window,
                 hop_length=self.hop_length
             )
 
-            audio_ = np.concatenate([audio_[start:end] for start, end in idxs])
+            # non-silent intervals are copied into a single preallocated array
+            trimmed = np.empty((idxs[:, 1] - idxs[:, 0]).sum(), dtype=audio.dtype)
+            offset = 0
+            for start, end in idxs:
+                trimmed[offset:offset + end - start] = audio[start:end]
+                offset += end - start
 
-        if add_silence:
-            audio_ = np.append(audio_, np.zeros(5 * self.hop_length))
+            audio = trimmed
 
-        audio_ = torch.FloatTensor(audio_.astype(np.float32))
-        audio_ = audio_.unsqueeze(0)
-        audio_ = torch.autograd.Variable(audio_, requires_grad=False)
+        if add_silence:
+            audio = np.append(audio, np.zeros(5 * self.hop_length, dtype=audio.dtype))
 
-        return audio_
+        return torch.from_numpy(audio).unsqueeze_(0)
 
 
     def get_mel_from_audio(self, audio):
@@ -187,14 +279,32 @@ class TextMelLoader(torch.utils.data.Dataset):
         return torch.squeeze(melspec, 0)
 
 
+    def get_mel_filepath(self, filename, mels_path=None):
+        mels_path = self.mels_path if mels_path is None else mels_path
+        mel_name, _ = os.path.splitext(filename)
+        extension = ".npy" if self.mel_codec is None else ".zst"
+
+        return os.path.join(mels_path, mel_name + extension)
+
+
     def get_mel(self, filename):
         if not self.load_mel_from_disk:
             audio = self.get_audio(filename, self.trim_silence, self.add_silence)
             melspec = self.stft.mel_spectrogram(audio)
             melspec = torch.squeeze(melspec, 0)
         else:
-            filepath = os.path.join(self.audio_path, filename)
-            melspec = torch.from_numpy(np.load(filepath))
+            filepath = self.get_mel_filepath(filename)
+            if self.mel_codec is not None:
+                return self.load_compressed_mel(filepath)
+
+            # mmap keeps the worker from reading the whole file into its own memory before the cast,
+            # so the cast (a no-op for float32 apart from the copy out of the read-only map) is the only pass
+            melspec = np.load(filepath, mmap_mode="r")
+            if melspec.dtype not in (np.float16, np.float32) and self.warn_on_mel_dtype:
+                warnings.warn("Mel-spectrograms on disk are stored as {}, float16 or float32 are expected "
+                              "(run precompute_mels.py to store them as float16)".format(melspec.dtype))
+                self.warn_on_mel_dtype = False
+            melspec = torch.from_numpy(melspec.astype(np.float32))
             assert melspec.size(0) == self.stft.n_mel_channels, (
                 'Mel dimension mismatch: given {}, expected {}'.format(
                     melspec.size(0), self.stft.n_mel_channels))
@@ -202,6 +312,44 @@ class TextMelLoader(torch.utils.data.Dataset):
         return melspec
 
 
+    def load_compressed_mel(self, filepath):
+        with open(filepath, "rb") as file:
+            melspec = self.mel_codec.decode(file.read())
+
+        melspec = np.frombuffer(melspec, dtype=np.float16).reshape(self.stft.n_mel_channels, -1)
+        return torch.from_numpy(melspec.astype(np.float32))
+
+
+    def save_compressed_mel(self, filepath, melspec):
+        with open(filepath, "wb") as file:
+            file.write(self.mel_codec.encode(melspec.astype(np.float16).tobytes()))
+
+
+    def precompute_mels(self, mels_path=None, device="cpu"):
+        """
+        Saves mel-spectrograms of all the dataset files as float16 .npy (or zstd-compressed .zst if compress_mels
+        is set) to be used with load_mel_from_disk
+        """
+        stft = self.stft.to(device)
+
+        for i in range(len(self)):
+            print("\rProcessing file #{} out of {}".format(i + 1, len(self)), end="")
+            audio_name = self.audio_names[i]
+            audio = self.get_audio(audio_name, self.trim_silence, self.add_silence)
+
+            with torch.no_grad():
+                melspec = stft.mel_spectrogram(audio.to(device))
+            melspec = torch.squeeze(melspec, 0).cpu().numpy()
+
+            filepath = self.get_mel_filepath(audio_name, mels_path)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            if self.mel_codec is not None:
+                self.save_compressed_mel(filepath, melspec)
+            else:
+                np.save(filepath, melspec.astype(np.float16))
+        print()
+
+
     def get_alignment(self, audio_name, mask_stress, mask_phonemes, target_shape):
         audio_name, _ = os.path.splitext(audio_name)
         alignment_name = audio_name + ".npy"
@@ -212,26 +360,38 @@ class TextMelLoader(torch.utils.data.Dataset):
             sub_dir = "original" if mask_stress else "stressed"
             filepath = os.path.join(self.alignment_path[sub_dir], alignment_name)
 
-            alignment = np.load(filepath)
+            # the matrix is only paged in when TextMelCollate copies it into the padded batch
+            alignment = np.load(filepath, mmap_mode="r")
 
         # TODO: поправить эту хрень с alignment
         if alignment is None or alignment.shape != target_shape:
             print("Some problems with {}: expected {} shape, got {}".format(audio_name, target_shape, alignment.shape))
-            alignment = np.zeros(shape=target_shape)
-
-        alignment = torch.FloatTensor(alignment)
+            alignment = np.zeros(shape=target_shape, dtype=np.float32)
 
         return alignment
 
 
     def get_ctc_text(self, sequence):
-        text = [self.text_handler.id_to_symbol[s] for s in sequence]
-        return torch.IntTensor([self.ctc_symbol_to_id[s] for s in text if s in self.ctc_symbol_to_id])
+        ctc_sequence = self._ctc_lut[sequence.long()]
+        # symbols absent in the ctc set are dropped with a single vectorized compare instead of membership tests
+        in_ctc_set = ctc_sequence >= 0
+
+        return ctc_sequence[in_ctc_set]
 
 
 class TextMelCollate:
-    def __init__(self, n_frames_per_step):
+    """
+    pin_memory: allocate the batch in page-locked memory, so it is copied to GPU asynchronously.
+    Pinning is done here only when collation runs in the main process (num_workers=0): DataLoader workers
+    can't use CUDA, so for them pass pin_memory=True to the DataLoader as well.
+    presorted: batches usually come already ordered by decreasing text length (see CustomSampler),
+    so the sort is skipped when the order is confirmed.
+    """
+    def __init__(self, n_frames_per_step, hop_length, pin_memory=False, presorted=False):
         self.n_frames_per_step = n_frames_per_step
+        self.hop_length = hop_length
+        self.pin_memory = pin_memory
+        self.presorted = presorted
 
 
     def __call__(self, batch):
@@ -239,65 +399,59 @@ class TextMelCollate:
         PARAMS
         ------
         batch: [text_normalized, mel_normalized]
+
+        If the batch holds raw audio instead of mel-spectrograms, audio is padded as is
+        and lengths and gate are calculated for the mel frames it will produce
         """
         # Right zero-pad all one-hot text sequences to max input length
         get_alignment = not any(elem[2] is None for elem in batch)
         get_ctc_text = not any(elem[3] is None for elem in batch)
 
-        batchsize = len(batch)
+        batch_audio = batch[0][1].dim() == 1
 
-        input_lengths, ids_sorted_decreasing = torch.sort(
-            torch.LongTensor([len(x[0]) for x in batch]),
-            dim=0, descending=True)
-        max_input_len = input_lengths[0]
-        max_target_len = max([x[1].size(1) for x in batch])
-        num_mels = batch[0][1].size(0)
+        batchsize = len(batch)
+        pin_memory = self.pin_memory and torch.utils.data.get_worker_info() is None
 
-        text_padded = torch.LongTensor(batchsize, max_input_len)
-        text_padded.zero_()
+        input_lengths = torch.LongTensor([len(x[0]) for x in batch])
+        # the sampler orders by raw text length, which may differ from the length of the sequence
+        if self.presorted and bool((input_lengths[:-1] >= input_lengths[1:]).all()):
+            ids_sorted_decreasing = list(range(batchsize))
+        else:
+            input_lengths, ids_sorted_decreasing = torch.sort(input_lengths, dim=0, descending=True)
+            ids_sorted_decreasing = ids_sorted_decreasing.tolist()
+        max_input_len = input_lengths[0].item()
+        if batch_audio:
+            target_lengths = [get_mel_length(x[1].size(0), self.hop_length) for x in batch]
+        else:
+            target_lengths = [x[1].size(1) for x in batch]
+        max_target_len = max(target_lengths)
 
-        mel_padded = torch.FloatTensor(batchsize, num_mels, max_target_len)
-        mel_padded.zero_()
+        text_padded = pad_sequence([batch[idx][0] for idx in ids_sorted_decreasing], batch_first=True)
 
-        gate_padded = torch.FloatTensor(batchsize, max_target_len)
-        gate_padded.zero_()
+        if batch_audio:
+            mel_padded = pad_sequence([batch[idx][1] for idx in ids_sorted_decreasing], batch_first=True)
+        else:
+            num_mels = batch[0][1].size(0)
+            # only the padding is zeroed by fill_padded, the rest is written once by the copy
+            mel_padded = torch.empty(batchsize, num_mels, max_target_len, pin_memory=pin_memory)
+            fill_padded(mel_padded.numpy(), [batch[idx][1].numpy() for idx in ids_sorted_decreasing])
 
         alignments_padded = None
         if get_alignment:
-            alignments_padded = torch.FloatTensor(batchsize, max_target_len, max_input_len)
-            alignments_padded.zero_()
+            alignments_padded = torch.empty(batchsize, max_target_len, max_input_len, pin_memory=pin_memory)
+            # alignments come as (possibly memory-mapped) numpy arrays
+            fill_padded(alignments_padded.numpy(), [batch[idx][2] for idx in ids_sorted_decreasing])
 
         ctc_text_padded = None
         ctc_text_lengths = None
         if get_ctc_text:
-            max_ctc_text_len = max([len(x[3]) for x in batch])
-
-            ctc_text_padded = torch.LongTensor(batchsize, max_ctc_text_len)
-            ctc_text_padded.zero_()
-
-            ctc_text_lengths = torch.LongTensor(batchsize)
-
-        output_lengths = torch.LongTensor(batchsize)
-
-        for i, idx in enumerate(ids_sorted_decreasing):
-            text, mel, alignment, ctc_text = batch[idx]
-
-            in_len = text.size(0)
-            target_len = mel.size(1)
-            output_lengths[i] = target_len
+            ctc_texts = [batch[idx][3] for idx in ids_sorted_decreasing]
 
-            text_padded[i, :in_len] = text
-            mel_padded[i, :, :target_len] = mel
-            gate_padded[i, target_len - 1:] = 1
+            ctc_text_padded = pad_sequence(ctc_texts, batch_first=True)
+            ctc_text_lengths = torch.LongTensor([len(ctc_text) for ctc_text in ctc_texts])
 
-            if get_alignment:
-                alignments_padded[i, :target_len, :in_len] = alignment
-
-            if get_ctc_text:
-                ctc_txt_len = ctc_text.size(0)
-                ctc_text_lengths[i] = ctc_txt_len
-
-                ctc_text_padded[i, :ctc_txt_len] = ctc_text
+        output_lengths = torch.LongTensor([target_lengths[idx] for idx in ids_sorted_decreasing])
+        gate_padded = (torch.arange(max_target_len) >= output_lengths.unsqueeze(1) - 1).float()
 
         # # Right zero-pad mel-spec
         # if max_target_len % self.n_frames_per_step != 0:
@@ -312,71 +466,104 @@ class TextMelCollate:
         return inputs, alignments_padded, inputs_ctc
 
 
+class BatchMelExtractor:
+    """Replaces the padded audio of a collated batch with mel-spectrograms computed on GPU in one pass"""
+    def __init__(self, hparams):
+        self.stft = build_stft(hparams)
+
+        if torch.cuda.is_available():
+            self.stft = self.stft.cuda()
+
+
+    def __call__(self, batch):
+        inputs, alignments, inputs_ctc = batch
+
+        audio = to_gpu(inputs.mels)
+        mel_len = to_gpu(inputs.mel_len)
+
+        with torch.no_grad():
+            mels = self.stft.mel_spectrogram(audio)
+
+        # frames built from the audio padding must be zeroed as in the per-item pipeline
+        mask = torch.arange(mels.size(2), device=mels.device) < mel_len.unsqueeze(1)
+        mels.masked_fill_(~mask.unsqueeze(1), 0.0)
+
+        inputs = inputs._replace(mels=mels, mel_len=mel_len)
+
+        return inputs, alignments, inputs_ctc
+
+
 class CustomSampler(torch.utils.data.Sampler):
     def __init__(self, data_source, batchsize, shuffle=False, optimize=False, len_diff=10):
-        idxs = tuple(range(len(data_source.data)))
-
         self.optimize = optimize
         self.shuffle = shuffle
         self.batchsize = batchsize
+        self.text_lengths = data_source.text_lengths
         self.optimized_idxs = []
 
-        if self.optimize:
-            text_lengths = tuple(len(elem[1]) for elem in data_source.data)
-            lengths_idxs_pairs = tuple(zip(text_lengths, idxs))
-
-            lengths_idxs_pairs = sorted(lengths_idxs_pairs, key=lambda elem: elem[0])
-
-            min_length = lengths_idxs_pairs[0][0]
+        self.idxs = None
+        # set by reshuffle until the new order is iterated over, so it isn't shuffled twice in a row
+        self._reshuffled = False
 
-            len_idxs = []
-            min_len = min_length
-            max_len = min_len + len_diff
-            for j, (length, idx) in enumerate(lengths_idxs_pairs):
-                if min_len <= length < max_len:
-                    len_idxs.append(idx)
-                    if j + 1 == len(lengths_idxs_pairs) and len_idxs:
-                        self.optimized_idxs.append(len_idxs)
-                else:
-                    self.optimized_idxs.append(len_idxs)
-                    len_idxs = [idx]
-                    min_len = length
-                    max_len = min_len + len_diff
+        if self.optimize:
+            order = np.argsort(data_source.text_lengths, kind="mergesort")
+            sorted_lengths = data_source.text_lengths[order]
 
-            idxs = tuple(chain(*self.optimized_idxs))
+            # buckets of len_diff width starting from the shortest text, the last one is closed by the dataset end
+            edges = np.arange(sorted_lengths[0], sorted_lengths[-1] + len_diff, len_diff)
+            splits = np.append(np.searchsorted(sorted_lengths, edges), len(sorted_lengths))
 
-        self.idxs = idxs
+            self.optimized_idxs = [order[start:end] for start, end in zip(splits[:-1], splits[1:]) if end > start]
 
         if self.shuffle:
             self.reshuffle()
+        else:
+            idxs = np.concatenate(self.optimized_idxs) if self.optimize else np.arange(len(self.text_lengths))
+            self.idxs = self.sort_batches(idxs)
 
 
     def __iter__(self):
-        for i in self.idxs:
-            yield i
-
-        if self.shuffle:
+        # the order is drawn when the epoch starts, not when the previous one is exhausted
+        if self.shuffle and not self._reshuffled:
             self.reshuffle()
 
+        self._reshuffled = False
+        return iter(self.idxs.tolist())
+
 
     def __len__(self):
         return len(self.idxs)
 
 
     def reshuffle(self):
-        def _torch_shuffle(iterable):
-            return tuple(iterable[i] for i in torch.randperm(len(iterable)).tolist())
+        def _torch_shuffle(array):
+            return array[torch.randperm(len(array)).numpy()]
 
-        idxs = tuple(_torch_shuffle(elem) for elem in self.optimized_idxs) if self.optimize else self.idxs
-        idxs = _torch_shuffle(idxs)
+        self._reshuffled = True
 
-        if self.optimize:
-            idxs = list(chain(*idxs))
+        if not self.optimize:
+            self.idxs = self.sort_batches(_torch_shuffle(np.arange(len(self.text_lengths))))
+            return
+
+        buckets = [_torch_shuffle(bucket) for bucket in self.optimized_idxs]
+        idxs = np.concatenate([buckets[i] for i in torch.randperm(len(buckets)).tolist()])
+
+        # the tail which doesn't fill the whole batch is dropped till the next reshuffle
+        batches = len(idxs) // self.batchsize
+        idxs = idxs[:batches * self.batchsize].reshape(batches, self.batchsize)
+
+        self.idxs = self.sort_batches(_torch_shuffle(idxs).ravel())
+
+
+    def sort_batches(self, idxs):
+        """Orders indices inside every batch by decreasing text length, so TextMelCollate may skip sorting"""
+        full_size = len(idxs) // self.batchsize * self.batchsize
 
-            batches = len(idxs) // self.batchsize
-            idxs = tuple(idxs[i * self.batchsize:(i + 1) * self.batchsize] for i in range(batches))
-            idxs = _torch_shuffle(idxs)
+        batches = idxs[:full_size].reshape(-1, self.batchsize)
+        order = np.argsort(-self.text_lengths[batches], axis=1, kind="mergesort")
+        batches = batches[np.arange(len(batches))[:, None], order]
 
-            idxs = list(chain(*idxs))
+        tail = idxs[full_size:]
+        tail = tail[np.argsort(-self.text_lengths[tail], kind="mergesort")]
 
-        self.idxs = idxs
\ No newline at end of file
+        return np.concatenate((batches.ravel(), tail))
\ No newline at end of file